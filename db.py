@@ -1,17 +1,18 @@
 from __future__ import annotations
 from abc import ABC, abstractmethod
-from binascii import hexlify
-from collections.abc import Iterable
+from collections.abc import Callable, Iterable
 from contextlib import closing
 from dataclasses import dataclass, field
 from datetime import date
 from enum import Enum
-from itertools import product
-from typing import Union, no_type_check
-import json
+from itertools import islice, product
+from typing import Any, Union
+import operator
 import os
 import pickle
 import struct
+import sys
+import zlib
 
 from berkeleydb import db as bdb
 
@@ -19,16 +20,28 @@ from db_messages import *
 
 Attr = Union[int, str, date, None]
 
+# display form of a value in SELECT output
+def format_attr(val: Attr) -> str:
+    if val is None:
+        return 'NULL'
+    elif isinstance(val, date):
+        return val.isoformat()
+    return str(val)
+
 class CClass(Enum):
     INT = 1
     CHAR = 2
     DATE = 3
 
-@dataclass
+# per-row and schema types are plain classes with __slots__, no per-instance
+# __dict__ and nothing generated that the hot paths do not use
 class CType:
-    cclass: CClass
-    cparam: int | None = None
-    nullable: bool = True
+    __slots__ = ('cclass', 'cparam', 'nullable')
+
+    def __init__(self, cclass: CClass, cparam: int | None = None, nullable: bool = True) -> None:
+        self.cclass = cclass
+        self.cparam = cparam
+        self.nullable = nullable
 
     # check if the given attr can be set for this type
     def check_type(self, attr: Attr) -> bool:
@@ -52,34 +65,73 @@ class CType:
             return False
         return True
 
-@dataclass
 class Column:
-    cname: str
-    ctype: CType
-
-@dataclass
-class FKey:
-    ref_tname: str
-    cname_map: dict[str, str]
+    __slots__ = ('cname', 'ctype')
 
-    def ref_record(self, ref_table: Table, record: Record) -> Record | None:
-        assert record.cnames is not None
+    def __init__(self, cname: str, ctype: CType) -> None:
+        self.cname = cname
+        self.ctype = ctype
 
-        ref_cnames: list[str] = []
-        ref_vals: list[Attr] = []
-        for cname, val in zip(record.cnames, record.vals):
-            if cname not in self.cname_map:
-                continue
-            ref_cname = self.cname_map[cname]
-            if ref_cname not in ref_table.pkeys:
-                continue
-            ref_cnames.append(ref_cname)
-            ref_vals.append(val)
+class FKey:
+    __slots__ = ('ref_tname', 'cname_map', '_projection')
+
+    def __init__(self, ref_tname: str, cname_map: dict[str, str]) -> None:
+        self.ref_tname = ref_tname
+        self.cname_map = cname_map
+        self._projection: list[tuple[int, str]] = []
+
+    # resolve source column positions, in the referenced table's pkey order
+    def bind(self, src_table: Table, ref_table: Table) -> None:
+        src_cnames = {ref_cname: cname for cname, ref_cname in self.cname_map.items()}
+        src_index = {col.cname: i for i, col in enumerate(src_table.cols)}
+        self._projection = [
+            (src_index[src_cnames[ref_cname]], ref_cname)
+            for ref_cname in ref_table.pkey_order
+        ]
+
+    # record must be a full record of the source table, must be bound first
+    def ref_record(self, record: Record) -> Record | None:
+        vals = [record.vals[i] for i, _ in self._projection]
 
         # if the entire fkey is NULL, allow
-        if all(val is None for val in ref_vals):
+        if all(val is None for val in vals):
             return None
-        return Record(ref_vals, ref_cnames)
+        return Record(vals, [ref_cname for _, ref_cname in self._projection])
+
+# binary encodings of non-NULL pkey values, by column class, as source
+# expressions over the value v
+_PKEY_PACK_SRCS: dict[CClass, str] = {
+    CClass.INT: "pack('>q', {v})",
+    CClass.CHAR: "pack_char({v})",
+    CClass.DATE: "pack('>HBB', {v}.year, {v}.month, {v}.day)",
+}
+
+def _pack_char(val: str) -> bytes:
+    raw = val.encode()
+    return struct.pack('>I', len(raw)) + raw
+
+# create does not validate pkey columns, so unknown ones are pickled
+_PKEY_PACK_OTHER_SRC = "pickle.dumps({v}, protocol=5)"
+
+_PKEY_PACK_GLOBALS: dict[str, Any] = {
+    'pack': struct.pack,
+    'pack_char': _pack_char,
+    'pickle': pickle,
+}
+
+# python type of values, by column class, as source
+_CHECK_TYPES: dict[CClass, str] = {
+    CClass.INT: 'int',
+    CClass.CHAR: 'str',
+    CClass.DATE: 'date',
+}
+
+# subdb holding the rows of a table, its name is also the schema db key
+def subdb_name(tname: str) -> str:
+    return f"ZZ_table_{tname}"
+
+def schema_key(tname: str) -> bytes:
+    return subdb_name(tname).encode()
 
 @dataclass
 class Table:
@@ -88,47 +140,252 @@ class Table:
     pkeys: set[str] = field(default_factory=set)
     fkeys: list[FKey] = field(default_factory=list)
 
-    def cnames(self) -> set[str]:
-        return {col.cname for col in self.cols}
+    def __post_init__(self) -> None:
+        self._intern_names()
+        self._prepare()
 
-    def find_col(self, cname: str) -> Column:
+    # names come from a small set and are compared all the time, intern them
+    # so equality checks mostly end at the identity check
+    def _intern_names(self) -> None:
+        self.tname = sys.intern(self.tname)
         for col in self.cols:
-            if col.cname == cname:
-                return col
-        raise KeyError
+            col.cname = sys.intern(col.cname)
+        self.pkeys = {sys.intern(cname) for cname in self.pkeys}
+        for fkey in self.fkeys:
+            fkey.ref_tname = sys.intern(fkey.ref_tname)
+            fkey.cname_map = {
+                sys.intern(cname): sys.intern(ref_cname)
+                for cname, ref_cname in fkey.cname_map.items()
+            }
+
+    def _prepare(self) -> None:
+        # storage keys
+        self.subdb_name = subdb_name(self.tname)
+        self.schema_key = self.subdb_name.encode()
+        self.rowid_key = f"ZZ_rowid_{self.tname}".encode()
+        self.refcnt_key = f"ZZ_refcnt_table_{self.tname}".encode()
+        # refcnt keys of rows: length-prefixed tname, then the raw pkey
+        tname_raw = self.tname.encode()
+        self.refcnt_record_prefix = b'ZZ_refcnt_record_' + struct.pack('<H', len(tname_raw)) + tname_raw
+
+        # columns by name
+        self._col_by_name = {col.cname: col for col in self.cols}
+        self._cnames = frozenset(self._col_by_name)
+        # column positions by name, and names in table order, shared by
+        # full records of this table and not to be modified
+        self.col_indices = {col.cname: i for i, col in enumerate(self.cols)}
+        self.cname_list = [col.cname for col in self.cols]
+
+        # pkey columns in a fixed order, encoded by a function generated
+        # for their types
+        self.pkey_order = sorted(self.pkeys)
+        parts: list[str] = []
+        for i, cname in enumerate(self.pkey_order):
+            try:
+                src = _PKEY_PACK_SRCS[self.find_col(cname).ctype.cclass]
+            except KeyError:
+                src = _PKEY_PACK_OTHER_SRC
+            # NULL is tagged apart, so every value encodes prefix-free
+            v = f'v[{i}]'
+            parts.append(f"(b'\\x00' if {v} is None else b'\\x01' + {src.format(v=v)})")
+
+        body = ' + '.join(parts) or "b''"
+        namespace = dict(_PKEY_PACK_GLOBALS)
+        exec(f'def encode(v):\n    return {body}\n', namespace)
+        self._pkey_encoder: Callable[[list[Attr]], bytes] = namespace['encode']
+
+        self._build_row_codec()
+        self._build_insert_checker()
+
+    # checks a full row in table order and returns it with CHARs truncated,
+    # generated as straight-line code for the column types; columns are
+    # checked in order, NULL before type, as CType.check_null/check_type
+    def _build_insert_checker(self) -> None:
+        names = [f'v{i}' for i in range(len(self.cols))]
+        lines = ['def check(v):', f"    [{', '.join(names)}] = v"]
+        for v, col in zip(names, self.cols):
+            ctype = col.ctype
+            pytype = _CHECK_TYPES[ctype.cclass]
+            if ctype.nullable:
+                lines.append(f'    if {v} is not None and not isinstance({v}, {pytype}):')
+                lines.append('        raise InsertTypeMismatchError')
+            else:
+                lines.append(f'    if {v} is None:')
+                lines.append(f'        raise InsertColumnNonNullableError({col.cname!r})')
+                lines.append(f'    if not isinstance({v}, {pytype}):')
+                lines.append('        raise InsertTypeMismatchError')
+            # truncate strings
+            if ctype.cclass == CClass.CHAR:
+                lines.append(f'    if {v} is not None:')
+                lines.append(f'        {v} = {v}[:{ctype.cparam!r}]')
+        lines.append(f"    return [{', '.join(names)}]")
+
+        namespace: dict[str, Any] = {
+            'date': date,
+            'InsertTypeMismatchError': InsertTypeMismatchError,
+            'InsertColumnNonNullableError': InsertColumnNonNullableError,
+        }
+        exec('\n'.join(lines), namespace)
+        self._insert_checker: Callable[[list[Attr]], list[Attr]] = namespace['check']
+
+    # vals must be a full row in table order
+    def check_insert(self, vals: list[Attr]) -> list[Attr]:
+        return self._insert_checker(vals)
+
+    # rows are a NULL bitmap, then INTs as i64 and DATEs as i32 ordinals in
+    # one fixed-width struct, then CHARs as u32 length and UTF-8 bytes; the
+    # codec is generated for the column types
+    def _build_row_codec(self) -> None:
+        n = len(self.cols)
+        nulls_size = (n + 7) // 8
+        fixed_fmt = '>'
+        fixed_vars: list[str] = []
+        null_exprs: list[str] = []
+        enc_fixed: list[str] = []
+        enc_chars: list[str] = []
+        dec_chars: list[str] = []
+        dec_vals: list[str] = []
+        for i, col in enumerate(self.cols):
+            null_exprs.append(f'(v[{i}] is None) << {i}')
+            null_test = f'nulls & {1 << i}'
+            if col.ctype.cclass == CClass.CHAR:
+                enc_chars.append(f"c{i} = b'' if v[{i}] is None else v[{i}].encode()")
+                dec_chars += [
+                    f"n, = unpack_from('>I', raw, pos)",
+                    f"c{i} = raw[pos + 4:pos + 4 + n].decode()",
+                    f"pos += 4 + n",
+                ]
+                dec_vals.append(f'None if {null_test} else c{i}')
+            elif col.ctype.cclass == CClass.DATE:
+                fixed_fmt += 'i'
+                fixed_vars.append(f'f{i}')
+                enc_fixed.append(f'0 if v[{i}] is None else v[{i}].toordinal()')
+                dec_vals.append(f'None if {null_test} else fromordinal(f{i})')
+            else:
+                fixed_fmt += 'q'
+                fixed_vars.append(f'f{i}')
+                enc_fixed.append(f'0 if v[{i}] is None else v[{i}]')
+                dec_vals.append(f'None if {null_test} else f{i}')
+        fixed = struct.Struct(fixed_fmt)
+
+        char_parts = ''.join(
+            f" + pack('>I', len(c{i})) + c{i}"
+            for i, col in enumerate(self.cols) if col.ctype.cclass == CClass.CHAR
+        )
+        src = '\n'.join([
+            'def encode(v):',
+            *(f'    {line}' for line in enc_chars),
+            f"    nulls = {' | '.join(null_exprs) or '0'}",
+            f"    return nulls.to_bytes({nulls_size}, 'big') + fixed.pack({', '.join(enc_fixed)}){char_parts}",
+            'def decode(raw):',
+            f"    nulls = int.from_bytes(raw[:{nulls_size}], 'big')",
+            f"    ({''.join(f'{var}, ' for var in fixed_vars)}) = fixed.unpack_from(raw, {nulls_size})",
+            f'    pos = {nulls_size + fixed.size}',
+            *(f'    {line}' for line in dec_chars),
+            f"    return [{', '.join(dec_vals)}]",
+        ])
+        namespace: dict[str, Any] = {
+            'fixed': fixed,
+            'pack': struct.pack,
+            'unpack_from': struct.unpack_from,
+            'fromordinal': date.fromordinal,
+        }
+        exec(src, namespace)
+        self._row_encoder: Callable[[list[Attr]], bytes] = namespace['encode']
+        self._row_decoder: Callable[[bytes], list[Attr]] = namespace['decode']
+
+    # vals must be a full, type checked row
+    def encode_row(self, vals: list[Attr]) -> bytes:
+        try:
+            return self._row_encoder(vals)
+        except struct.error:
+            # INT out of range
+            raise InsertTypeMismatchError
+
+    def decode_row(self, raw: bytes) -> list[Attr]:
+        return self._row_decoder(raw)
+
+    # pkey values must be in pkey_order
+    def encode_pkey(self, vals: list[Attr]) -> bytes:
+        try:
+            return self._pkey_encoder(vals)
+        except struct.error:
+            # INT out of range
+            raise InsertTypeMismatchError
+
+    def cnames(self) -> frozenset[str]:
+        return self._cnames
+
+    def find_col(self, cname: str) -> Column:
+        return self._col_by_name[cname]
+
+# stored schema format, bump on incompatible changes
+SCHEMA_VERSION = 1
+# set in the version byte when the payload is zlib compressed, done only
+# for payloads of at least SCHEMA_ZLIB_MIN bytes
+SCHEMA_ZLIB = 0x80
+SCHEMA_ZLIB_MIN = 256
+
+# stored form of a table, plain containers only
+def _table_to_dict(table: Table) -> dict[str, Any]:
+    return {
+        'tname': table.tname,
+        'cols': [
+            (col.cname, col.ctype.cclass.value, col.ctype.cparam, col.ctype.nullable)
+            for col in table.cols
+        ],
+        'pkeys': sorted(table.pkeys),
+        'fkeys': [(fkey.ref_tname, list(fkey.cname_map.items())) for fkey in table.fkeys],
+    }
+
+def _table_from_dict(d: dict[str, Any]) -> Table:
+    return Table(
+        tname=d['tname'],
+        cols=[
+            Column(cname, CType(CClass(cclass), cparam, nullable))
+            for cname, cclass, cparam, nullable in d['cols']
+        ],
+        pkeys=set(d['pkeys']),
+        fkeys=[FKey(ref_tname, dict(cname_map)) for ref_tname, cname_map in d['fkeys']],
+    )
+
+def encode_table(table: Table) -> bytes:
+    payload = pickle.dumps(_table_to_dict(table), protocol=5)
+    if len(payload) >= SCHEMA_ZLIB_MIN:
+        compressed = zlib.compress(payload, 1)
+        if len(compressed) < len(payload):
+            return bytes([SCHEMA_VERSION | SCHEMA_ZLIB]) + compressed
+    return bytes([SCHEMA_VERSION]) + payload
+
+def decode_table(raw: bytes) -> Table:
+    version = raw[0] & ~SCHEMA_ZLIB
+    if version != SCHEMA_VERSION:
+        raise ValueError(f'unknown schema version {version}')
+    payload = raw[1:]
+    if raw[0] & SCHEMA_ZLIB:
+        payload = zlib.decompress(payload)
+    return _table_from_dict(pickle.loads(payload))
 
-@dataclass
 class Record:
-    vals: list[Attr]
-    cnames: list[str] | None = None
+    __slots__ = ('vals', 'cnames')
 
-    # convert to given table's pkey, cnames must be set
-    def pkey(self, table: Table) -> bytes:
-        # if no pkey, ensure unique value
-        if len(table.pkeys) == 0:
-            return hexlify(os.urandom(16))
+    def __init__(self, vals: list[Attr], cnames: list[str] | None = None) -> None:
+        self.vals = vals
+        self.cnames = cnames
 
+    # convert to given table's pkey, cnames must be set and the table must
+    # have a pkey
+    def pkey(self, table: Table) -> bytes:
         assert(self.cnames is not None)
-        pkey: list[Attr | list[int]] = []
-        for cname, val in zip(self.cnames, self.vals):
-            if cname not in table.pkeys:
-                continue
-            if isinstance(val, date):
-                pkey.append([val.year, val.month, val.day])
-            else:
-                pkey.append(val)
-        return json.dumps(pkey).encode()
+        by_cname = dict(zip(self.cnames, self.vals))
+        return table.encode_pkey([by_cname.get(cname) for cname in table.pkey_order])
 
-@dataclass
 class Ident:
-    tname: str | None
-    cname: str
+    __slots__ = ('tname', 'cname')
 
-    def match(self, other: Ident) -> bool:
-        if (self.tname is not None) and (other.tname is not None):
-            if other.tname != self.tname:
-                return False
-        return self.cname == other.cname
+    def __init__(self, tname: str | None, cname: str) -> None:
+        self.tname = tname
+        self.cname = cname
 
 Operand = Union[Ident, int, str, date]
 
@@ -140,101 +397,235 @@ class CompOp(Enum):
     EQUAL = 5
     NOTEQUAL = 6
 
+_COMP_FUNCS: dict[CompOp, Callable[[Any, Any], bool]] = {
+    CompOp.LESSTHAN: operator.lt,
+    CompOp.LESSEQUAL: operator.le,
+    CompOp.GREATERTHAN: operator.gt,
+    CompOp.GREATEREQUAL: operator.ge,
+    CompOp.EQUAL: operator.eq,
+    CompOp.NOTEQUAL: operator.ne,
+}
+
 @dataclass
 class View:
     idents: list[Ident]
     cols: list[Column]
 
-    def find(self, ident: Ident) -> Column:
+    def __post_init__(self) -> None:
+        # positions by (tname, cname) and by cname only
+        self._tnames = {ident.tname for ident in self.idents}
+        self._by_qualified: dict[tuple[str | None, str], list[int]] = {}
+        self._by_unqualified: dict[str, list[int]] = {}
+        for i, ident in enumerate(self.idents):
+            self._by_qualified.setdefault((ident.tname, ident.cname), []).append(i)
+            self._by_unqualified.setdefault(ident.cname, []).append(i)
+
+    # position of ident in records of this view
+    def index(self, ident: Ident) -> int:
         # no need to match table if not set
-        match_table = ident.tname is None
-        match_ident = False
-        match: Column | None = None
-
-        for view_ident, col in zip(self.idents, self.cols):
-            if ident.tname is not None:
-                if view_ident.tname != ident.tname:
-                    continue
-                match_table = True
-
-            if view_ident.cname != ident.cname:
-                continue
-
-            if match_ident:
-                raise WhereAmbiguousReference
-            match_ident = True
-            match = col
-
-        if not match_table:
+        if ident.tname is None:
+            matches = self._by_unqualified.get(ident.cname, [])
+        elif ident.tname not in self._tnames:
             raise WhereTableNotSpecified
-        if not match_ident:
+        else:
+            matches = self._by_qualified.get((ident.tname, ident.cname), [])
+
+        if len(matches) > 1:
+            raise WhereAmbiguousReference
+        if len(matches) == 0:
             raise WhereColumnNotExist
-        assert match is not None
-        return match
+        return matches[0]
+
+    def find(self, ident: Ident) -> Column:
+        return self.cols[self.index(ident)]
 
-@dataclass
 class QualRecord:
-    vals: list[Attr]
-    idents: list[Ident]
+    __slots__ = ('vals', 'idents')
+
+    def __init__(self, vals: list[Attr], idents: list[Ident]) -> None:
+        self.vals = vals
+        self.idents = idents
 
     def unqual(self) -> Record:
         return Record(self.vals, [ident.cname for ident in self.idents])
 
-    def find(self, ident: Ident) -> Attr:
-        for view_ident, val in zip(self.idents, self.vals):
-            if not view_ident.match(ident):
-                continue
-            return val
-        raise Exception('unreachable code')
+# where clauses compile to postfix code, a list of (opcode, arg), run by
+# run_where over the values of a single record
+OP_CONST = 0            # push arg
+OP_IS_NULL = 1          # push vals[arg] is None
+OP_EQ_IDX_LIT = 2       # push vals[i] == lit, arg is (i, lit)
+OP_COMP_IDX_LIT = 3     # push comp(vals[i], lit), arg is (comp, i, lit)
+OP_COMP_LIT_IDX = 4     # push comp(lit, vals[i]), arg is (comp, lit, i)
+OP_COMP_IDX_IDX = 5     # push comp(vals[i], vals[j]), arg is (comp, i, j)
+OP_NOT = 6              # negate top
+OP_JUMP_IF_FALSE = 7    # if top is false skip arg ops, else pop it
+OP_JUMP_IF_TRUE = 8     # if top is true skip arg ops, else pop it
+
+Code = list[tuple[int, Any]]
+
+# comparisons against NULL are false
+def run_where(code: Code, vals: list[Attr]) -> bool:
+    stack: list[bool] = []
+    ops = iter(code)
+    for op, arg in ops:
+        if op == OP_EQ_IDX_LIT:
+            val = vals[arg[0]]
+            stack.append(val is not None and val == arg[1])
+        elif op == OP_COMP_IDX_LIT:
+            val = vals[arg[1]]
+            stack.append(val is not None and arg[0](val, arg[2]))
+        elif op == OP_IS_NULL:
+            stack.append(vals[arg] is None)
+        elif op == OP_JUMP_IF_FALSE:
+            if stack[-1]:
+                stack.pop()
+            else:
+                # consume the skipped ops
+                next(islice(ops, arg, arg), None)
+        elif op == OP_JUMP_IF_TRUE:
+            if stack[-1]:
+                next(islice(ops, arg, arg), None)
+            else:
+                stack.pop()
+        elif op == OP_NOT:
+            stack[-1] = not stack[-1]
+        elif op == OP_COMP_LIT_IDX:
+            val = vals[arg[2]]
+            stack.append(val is not None and arg[0](arg[1], val))
+        elif op == OP_COMP_IDX_IDX:
+            left_val = vals[arg[1]]
+            right_val = vals[arg[2]]
+            stack.append(left_val is not None and right_val is not None and arg[0](left_val, right_val))
+        else:
+            stack.append(arg)
+    return stack[-1]
+
+# chain children so evaluation stops at the first child deciding the result
+def _chain(codes: list[Code], jump: int) -> Code:
+    code = codes[-1]
+    for child in reversed(codes[:-1]):
+        code = child + [(jump, len(code))] + code
+    return code
 
 class Where(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def validate(self, view: View) -> None: ...
+    # code evaluating records of view, must be validated against view first
     @abstractmethod
-    def evaluate(self, record: QualRecord) -> bool: ...
+    def compile(self, view: View) -> Code: ...
+    # positions of columns referenced, must be valid for view
+    @abstractmethod
+    def columns(self, view: View) -> set[int]: ...
+
+    # terms that are AND-ed together
+    def conjuncts(self) -> list[Where]:
+        return [self]
+
+    # split into filters over a single table and the rest; owners gives the
+    # position of the table of each column of view, filters are keyed by it,
+    # as aliases need not be unique
+    def split_by_table(self, view: View, owners: list[int]) -> tuple[dict[int, Where], Where]:
+        split: dict[int, list[Where]] = {}
+        residual: list[Where] = []
+        for wh in self.conjuncts():
+            tables = {owners[i] for i in wh.columns(view)}
+            if len(tables) == 1:
+                split.setdefault(tables.pop(), []).append(wh)
+                continue
+            residual.append(wh)
+
+        filters = {pos: where_all(whs) for pos, whs in split.items()}
+        return filters, where_all(residual)
+
+    # rough evaluation order for AND/OR children, lower runs first:
+    # cheap and selective predicates before whole subtrees
+    def cost(self) -> int:
+        return 5
 
 class WhereNOP(Where):
+    __slots__ = ()
+
     def validate(self, view: View) -> None:
         pass
-    def evaluate(self, record: QualRecord) -> bool:
-        return True
-
+    def compile(self, view: View) -> Code:
+        return [(OP_CONST, True)]
+    def columns(self, view: View) -> set[int]:
+        return set()
+    def cost(self) -> int:
+        return 0
+
+# children are validated in query order, but evaluated cheapest first
 class WhereAnd(Where):
-    def __init__(self, *wheres: Where) -> None:
+    __slots__ = ('wheres',)
+
+    def __init__(self, wheres: list[Where]) -> None:
         self.wheres = wheres
     def validate(self, view: View) -> None:
         for wh in self.wheres:
             wh.validate(view)
-    def evaluate(self, record: QualRecord) -> bool:
-        return all(wh.evaluate(record) for wh in self.wheres)
+    def compile(self, view: View) -> Code:
+        ordered = sorted(self.wheres, key=lambda wh: wh.cost())
+        return _chain([wh.compile(view) for wh in ordered], OP_JUMP_IF_FALSE)
+    def columns(self, view: View) -> set[int]:
+        return set().union(*(wh.columns(view) for wh in self.wheres))
+    def conjuncts(self) -> list[Where]:
+        return [conj for wh in self.wheres for conj in wh.conjuncts()]
+
+# AND of all wheres, without wrapping trivial cases
+def where_all(wheres: list[Where]) -> Where:
+    if len(wheres) == 0:
+        return WhereNOP()
+    elif len(wheres) == 1:
+        return wheres[0]
+    return WhereAnd(wheres)
 
 class WhereOr(Where):
-    def __init__(self, *wheres: Where) -> None:
+    __slots__ = ('wheres',)
+
+    def __init__(self, wheres: list[Where]) -> None:
         self.wheres = wheres
     def validate(self, view: View) -> None:
         for wh in self.wheres:
             wh.validate(view)
-    def evaluate(self, record: QualRecord) -> bool:
-        return any(wh.evaluate(record) for wh in self.wheres)
+    def compile(self, view: View) -> Code:
+        ordered = sorted(self.wheres, key=lambda wh: wh.cost())
+        return _chain([wh.compile(view) for wh in ordered], OP_JUMP_IF_TRUE)
+    def columns(self, view: View) -> set[int]:
+        return set().union(*(wh.columns(view) for wh in self.wheres))
 
 class WhereNot(Where):
+    __slots__ = ('where',)
+
     def __init__(self, where: Where) -> None:
         self.where = where
     def validate(self, view: View) -> None:
         self.where.validate(view)
-    def evaluate(self, record: QualRecord) -> bool:
-        return self.where.evaluate(record)
+    def compile(self, view: View) -> Code:
+        return self.where.compile(view) + [(OP_NOT, None)]
+    def columns(self, view: View) -> set[int]:
+        return self.where.columns(view)
+    def cost(self) -> int:
+        return 3
 
 class WhereNull(Where):
+    __slots__ = ('ident',)
+
     def __init__(self, ident: Ident) -> None:
         self.ident = ident
+    def cost(self) -> int:
+        return 1
     def validate(self, view: View) -> None:
-        view.find(self.ident)
-    def evaluate(self, record: QualRecord) -> bool:
-        attr = record.find(self.ident)
-        return attr is None
+        view.index(self.ident)
+    def compile(self, view: View) -> Code:
+        return [(OP_IS_NULL, view.index(self.ident))]
+    def columns(self, view: View) -> set[int]:
+        return {view.index(self.ident)}
 
 class WhereComp(Where):
+    __slots__ = ('left', 'right', 'oper')
+
     def __init__(self, left: Operand, right: Operand, oper: CompOp) -> None:
         self.left = left
         self.right = right
@@ -251,245 +642,315 @@ class WhereComp(Where):
         elif cclass == CClass.DATE:
             return date
 
-    def _get_value(self, record: QualRecord, op: Operand) -> Attr:
-        if not isinstance(op, Ident):
-            return op
-        return record.find(op)
-
     def validate(self, view: View) -> None:
         left_type = self._get_type(view, self.left)
         right_type = self._get_type(view, self.right)
         if left_type != right_type:
             raise WhereIncomparableError
-        elif self.oper == CompOp.LESSTHAN:
-            if left_type == int or left_type == date:
-                return
-        elif self.oper == CompOp.LESSEQUAL:
-            if left_type == int or left_type == date:
-                return
-        elif self.oper == CompOp.GREATERTHAN:
-            if left_type == int or left_type == date:
-                return
-        elif self.oper == CompOp.GREATEREQUAL:
-            if left_type == int or left_type == date:
-                return
-        elif self.oper == CompOp.EQUAL or self.oper == CompOp.NOTEQUAL:
-            return
-        raise WhereIncomparableError
+        # only ints and dates are ordered
+        if self.oper != CompOp.EQUAL and self.oper != CompOp.NOTEQUAL:
+            if left_type != int and left_type != date:
+                raise WhereIncomparableError
 
-    @no_type_check
-    def evaluate(self, record: QualRecord) -> bool:
-        left_val = self._get_value(record, self.left)
-        right_val = self._get_value(record, self.right)
-        if (left_val is None) or (right_val is None):
-            return False
-        if self.oper == CompOp.LESSTHAN:
-            return left_val < right_val
-        elif self.oper == CompOp.LESSEQUAL:
-            return left_val <= right_val
-        elif self.oper == CompOp.GREATERTHAN:
-            return left_val > right_val
-        elif self.oper == CompOp.GREATEREQUAL:
-            return left_val >= right_val
-        elif self.oper == CompOp.EQUAL:
-            return left_val == right_val
+    def columns(self, view: View) -> set[int]:
+        return {view.index(op) for op in (self.left, self.right) if isinstance(op, Ident)}
+
+    def cost(self) -> int:
+        if self.oper == CompOp.EQUAL:
+            return 0
         elif self.oper == CompOp.NOTEQUAL:
-            return left_val != right_val
+            return 4
+        return 2
+
+    # operand kinds and ident positions are fixed, pick the opcode here
+    def compile(self, view: View) -> Code:
+        comp = _COMP_FUNCS[self.oper]
+        left = self.left
+        right = self.right
+
+        if isinstance(left, Ident) and isinstance(right, Ident):
+            return [(OP_COMP_IDX_IDX, (comp, view.index(left), view.index(right)))]
+        elif isinstance(left, Ident):
+            if self.oper == CompOp.EQUAL:
+                return [(OP_EQ_IDX_LIT, (view.index(left), right))]
+            return [(OP_COMP_IDX_LIT, (comp, view.index(left), right))]
+        elif isinstance(right, Ident):
+            return [(OP_COMP_LIT_IDX, (comp, left, view.index(right)))]
+        # literals only, fold
+        return [(OP_CONST, comp(left, right))]
 
-@dataclass
 class TableView:
-    tnames: list[str]
-    alt_tnames: list[str]
+    __slots__ = ('tnames', 'alt_tnames')
+
+    def __init__(self, tnames: list[str], alt_tnames: list[str]) -> None:
+        self.tnames = tnames
+        self.alt_tnames = alt_tnames
 
-@dataclass
 class ColumnView:
-    idents: list[Ident]
-    alt_cnames: list[str]
-
-    def project(self, record: QualRecord) -> QualRecord:
-        p_record = QualRecord([], [])
-        for c_ident, c_cname in zip(self.idents, self.alt_cnames):
-            for r_ident, r_val in zip(record.idents, record.vals):
-                if r_ident.match(c_ident):
-                    break
-            p_record.vals.append(r_val)
-            p_record.idents.append(Ident(None, c_cname))
-        return p_record
+    __slots__ = ('idents', 'alt_cnames', 'indices')
+
+    def __init__(self, idents: list[Ident], alt_cnames: list[str]) -> None:
+        self.idents = idents
+        self.alt_cnames = alt_cnames
+        self.indices: list[int] = []
+
+    # resolve selected columns to positions in records of view
+    def bind(self, view: View) -> None:
+        self.indices = []
+        for ident in self.idents:
+            try:
+                self.indices.append(view.index(ident))
+            except DBError:
+                raise SelectColumnResolveError(ident.cname)
+
+# row ids reserved at once for tables without pkeys
+ROWID_BLOCK = 1024
+# shared BDB buffer pool, in bytes
+CACHE_SIZE = 64 << 20
 
 class DB:
     def __init__(self, filename: str) -> None:
-        self.filename = filename
-
-        schema_db = bdb.DB()
-        schema_db.open(filename, dbname='SCHEMA', dbtype=bdb.DB_HASH, flags=bdb.DB_CREATE)
+        # every handle shares one buffer pool, kept in process memory; no
+        # logging or transactions, same durability as standalone handles
+        path = os.path.abspath(filename)
+        env = bdb.DBEnv()
+        env.set_cachesize(0, CACHE_SIZE, 1)
+        env.open(os.path.dirname(path), bdb.DB_CREATE | bdb.DB_INIT_MPOOL | bdb.DB_PRIVATE)
+        self.env = env
+        # relative to the environment home
+        self.filename = os.path.basename(path)
+
+        schema_db = bdb.DB(env)
+        schema_db.open(self.filename, dbname='SCHEMA', dbtype=bdb.DB_HASH, flags=bdb.DB_CREATE)
         self.schema_db = schema_db
 
+        # unpickled tables, keyed by tname
+        self._table_cache: dict[str, Table] = {}
+        # open table handles, keyed by tname
+        self._handle_cache: dict[str, bdb.DB] = {}
+        # next row id and end of its reserved block for tables without
+        # pkeys, keyed by tname
+        self._rowids: dict[str, tuple[int, int]] = {}
+        # pending refcnt changes, keyed by refcnt key
+        self._refcnt_deltas: dict[bytes, int] = {}
+
     def close(self) -> None:
+        # give back the unused part of reserved row id blocks
+        for tname, (rowid, _) in self._rowids.items():
+            self.schema_db.put(self._table_cache[tname].rowid_key, struct.pack('<Q', rowid))
+        self._rowids.clear()
+
+        for tdb in self._handle_cache.values():
+            tdb.close()
+        self._handle_cache.clear()
         self.schema_db.close()
+        self.env.close()
 
     def _get_table(self, tname: str) -> Table:
-        table_raw = self.schema_db.get(f"ZZ_table_{tname}".encode())
+        if tname in self._table_cache:
+            return self._table_cache[tname]
+
+        table_raw = self.schema_db.get(schema_key(tname))
         if table_raw is None:
             raise KeyError
-        table = pickle.loads(table_raw)
-        assert isinstance(table, Table)
+        table = decode_table(table_raw)
+        self._bind_fkeys(table)
+        self._table_cache[tname] = table
         return table
 
-    def _put_table(self, table: Table) -> None:
-        table_raw = pickle.dumps(table)
-        self.schema_db.put(f"ZZ_table_{table.tname}".encode(), table_raw, flags=bdb.DB_NOOVERWRITE)
+    # referenced tables exist as long as table does
+    def _bind_fkeys(self, table: Table) -> None:
+        for fkey in table.fkeys:
+            fkey.bind(table, self._get_table(fkey.ref_tname))
 
-    def _open_table(self, tname: str) -> closing[bdb.DB]:
-        tdb = bdb.DB()
-        tdb.open(self.filename, dbname=f"ZZ_table_{tname}", dbtype=bdb.DB_HASH, flags=bdb.DB_CREATE)
-        return closing(tdb)
+    def _put_table(self, table: Table) -> None:
+        table_raw = encode_table(table)
+        self.schema_db.put(table.schema_key, table_raw, flags=bdb.DB_NOOVERWRITE)
+        self._bind_fkeys(table)
+        self._table_cache[table.tname] = table
+
+    # handles stay open until close(), do not close them
+    def _open_table(self, table: Table) -> bdb.DB:
+        if table.tname in self._handle_cache:
+            return self._handle_cache[table.tname]
+
+        tdb = bdb.DB(self.env)
+        tdb.open(self.filename, dbname=table.subdb_name, dbtype=bdb.DB_HASH, flags=bdb.DB_CREATE)
+        self._handle_cache[table.tname] = tdb
+        return tdb
+
+    # key for a row of a table without pkey, unique within the table; ids
+    # come from blocks reserved in the schema db, so a crash may skip ids
+    # but never reuses one
+    def _next_rowid(self, table: Table) -> bytes:
+        if table.tname in self._rowids:
+            rowid, limit = self._rowids[table.tname]
+        else:
+            rowid = limit = self._stored_rowid(table)
+
+        if rowid == limit:
+            limit = rowid + ROWID_BLOCK
+            self.schema_db.put(table.rowid_key, struct.pack('<Q', limit))
+        self._rowids[table.tname] = (rowid + 1, limit)
+        return struct.pack('>Q', rowid)
+
+    # the block is reserved before any id of it is used, so a table without
+    # a stored counter has no rows yet
+    def _stored_rowid(self, table: Table) -> int:
+        rowid_raw = self.schema_db.get(table.rowid_key)
+        if rowid_raw is None:
+            return 0
+        rowid: int = struct.unpack('<Q', rowid_raw)[0]
+        return rowid
 
     def _put_record(self, table: Table, record: Record) -> None:
-        with self._open_table(table.tname) as tdb:
+        tdb = self._open_table(table)
+        if table.pkeys:
             pkey = record.pkey(table)
-            vals_raw = json.dumps(record.vals).encode()
-            tdb.put(pkey, vals_raw, flags=bdb.DB_NOOVERWRITE)
-
-    def _decode_record(self, table: Table, raw: bytes) -> QualRecord:
-        record_dec = json.loads(raw)
-        vals: list[Attr] = []
-        for elem in record_dec:
-            if elem is None:
-                vals.append(None)
-                continue
-            if isinstance(elem, int):
-                vals.append(elem)
-            elif isinstance(elem, str):
-                vals.append(elem)
-            elif isinstance(elem, list):
-                vals.append(date(*elem))
-        return QualRecord(
-            vals=vals,
-            idents=[Ident(table.tname, col.cname) for col in table.cols],
-        )
-
-    def _get_record(self, table: Table, pkey: bytes) -> QualRecord:
-        with self._open_table(table.tname) as tdb:
-            record_raw = tdb.get(pkey)
-            if record_raw is None:
-                raise KeyError
-            return self._decode_record(table, record_raw)
-
-    def _delete_records(self, table: Table, where: Where) -> int:
-        count = 0
-        fkey_failed = False
-        with self._open_table(table.tname) as tdb:
-            # first pass, count and check fkeys
-            with closing(tdb.cursor()) as c:
-                while row := c.next():
-                    record = self._decode_record(table, row[1])
-                    if not where.evaluate(record):
-                        continue
-                    count += 1
-
-                    pkey = record.unqual().pkey(table)
-                    refcnt = self._get_refcnt_record(table.tname, pkey)
-                    if refcnt > 0:
-                        fkey_failed = True
-
-            if fkey_failed:
-                raise DeleteReferentialIntegrityPassed(count)
-
-            # second pass, delete and decrement
-            with closing(tdb.cursor()) as c:
-                while row := c.next():
-                    record = self._decode_record(table, row[1])
-                    if not where.evaluate(record):
-                        continue
-
-                    c.delete()
+        else:
+            pkey = self._next_rowid(table)
+        vals_raw = table.encode_row(record.vals)
+        tdb.put(pkey, vals_raw, flags=bdb.DB_NOOVERWRITE)
+
+    # idents are shared by every record of a scan, build them once
+    def _decode_record(self, table: Table, raw: bytes, idents: list[Ident]) -> QualRecord:
+        return QualRecord(table.decode_row(raw), idents)
+
+    # where must be validated against view
+    def _delete_records(self, table: Table, view: View, where: Where) -> int:
+        tdb = self._open_table(table)
+        idents = view.idents
+        code = where.compile(view)
+
+        # resolve referenced tables once, not per row
+        ref_tables = [self._get_table(fkey.ref_tname) for fkey in table.fkeys]
+
+        # single cursor pass, keep the key and referenced rows of each match;
+        # only matches are held, not the table
+        matches: list[tuple[bytes, list[tuple[Table, bytes]]]] = []
+        with closing(tdb.cursor()) as c:
+            while row := c.next():
+                key, raw = row
+                record = self._decode_record(table, raw, idents)
+                if not run_where(code, record.vals):
+                    continue
 
-                    # decrement fkey refcnt
-                    for fkey in table.fkeys:
-                        ref_table = self._get_table(fkey.ref_tname)
-                        ref_record = fkey.ref_record(ref_table, record.unqual())
+                ref_keys: list[tuple[Table, bytes]] = []
+                if table.fkeys:
+                    unqual = record.unqual()
+                    for fkey, ref_table in zip(table.fkeys, ref_tables):
+                        ref_record = fkey.ref_record(unqual)
                         if ref_record is None:
                             continue
-                        ref_pkey = ref_record.pkey(ref_table)
-                        self._add_refcnt_record(ref_table.tname, ref_pkey, -1)
-        return count
-
-    def _generate_records(self, table: Table, alt_tname: str) -> Iterable[QualRecord]:
-        with self._open_table(table.tname) as tdb:
-            with closing(tdb.cursor()) as c:
-                while row := c.next():
-                    record = self._decode_record(table, row[1])
-                    record = QualRecord(
-                        record.vals,
-                        [Ident(alt_tname, ident.cname) for ident in record.idents],
-                    )
+                        ref_keys.append((ref_table, ref_record.pkey(ref_table)))
+                matches.append((key, ref_keys))
+
+        # check fkeys, records are stored under their pkey
+        for key, _ in matches:
+            if self._get_refcnt_record(table, key) > 0:
+                raise DeleteReferentialIntegrityPassed(len(matches))
+
+        # delete, with one refcnt update per referenced row
+        for key, ref_keys in matches:
+            tdb.delete(key)
+            for ref_table, ref_pkey in ref_keys:
+                self._add_refcnt_record(ref_table, ref_pkey, -1)
+        self._flush_refcnts()
+        return len(matches)
+
+    # where must be validated against view, the table's view under its
+    # alt_tname; rows are read through a cursor as they are consumed
+    def _generate_records(self, table: Table, view: View, where: Where) -> Iterable[QualRecord]:
+        tdb = self._open_table(table)
+        idents = view.idents
+        code = None if isinstance(where, WhereNOP) else where.compile(view)
+        with closing(tdb.cursor()) as c:
+            while row := c.next():
+                record = self._decode_record(table, row[1], idents)
+                if code is None or run_where(code, record.vals):
                     yield record
 
-    def _get_refcnt_table(self, tname: str) -> int:
-        refcnt_raw = self.schema_db.get(f"ZZ_refcnt_table_{tname}".encode())
+    def _get_refcnt(self, key: bytes) -> int:
+        refcnt_raw = self.schema_db.get(key)
         if refcnt_raw is None:
             return 0
-        refcnt = struct.unpack('<i', refcnt_raw)[0]
-        assert isinstance(refcnt, int)
+        refcnt: int = struct.unpack('<i', refcnt_raw)[0]
         return refcnt
 
-    def _add_refcnt_table(self, tname: str, delta: int) -> None:
-        refcnt = self._get_refcnt_table(tname)
-        refcnt += delta
-        self.schema_db.put(f"ZZ_refcnt_table_{tname}".encode(), struct.pack('<i', refcnt))
+    # changes are only collected, _flush_refcnts writes them
+    def _refcnt_delta(self, key: bytes, delta: int) -> None:
+        self._refcnt_deltas[key] = self._refcnt_deltas.get(key, 0) + delta
 
-    def _get_refcnt_record(self, tname: str, pkey: bytes) -> int:
-        name = json.dumps([tname, pkey.decode()]).encode()
-        refcnt_raw = self.schema_db.get(b'ZZ_refcnt_record_' + name)
-        if refcnt_raw is None:
-            return 0
-        refcnt = struct.unpack('<i', refcnt_raw)[0]
-        assert isinstance(refcnt, int)
-        return refcnt
+    # one read and one write per changed refcnt, zero counts are removed
+    def _flush_refcnts(self) -> None:
+        for key, delta in self._refcnt_deltas.items():
+            if delta == 0:
+                continue
+            refcnt = self._get_refcnt(key) + delta
+            if refcnt == 0:
+                self.schema_db.delete(key)
+            else:
+                self.schema_db.put(key, struct.pack('<i', refcnt))
+        self._refcnt_deltas.clear()
 
-    def _add_refcnt_record(self, tname: str, pkey: bytes, delta: int) -> None:
-        name = json.dumps([tname, pkey.decode()]).encode()
-        refcnt = self._get_refcnt_record(tname, pkey)
-        refcnt += delta
-        self.schema_db.put(b'ZZ_refcnt_record_' + name, struct.pack('<i', refcnt))
+    def _get_refcnt_table(self, table: Table) -> int:
+        return self._get_refcnt(table.refcnt_key)
 
-    def _render_select(self, headers: list[str], rows: list[list[Attr]]) -> str:
-        msgs: list[list[str]] = []
-        for row in rows:
-            msg: list[str] = []
-            for val in row:
-                if val is None:
-                    msg.append('NULL')
-                elif isinstance(val, date):
-                    msg.append(val.isoformat())
-                else:
-                    msg.append(str(val))
-            msgs.append(msg)
+    def _add_refcnt_table(self, table: Table, delta: int) -> None:
+        self._refcnt_delta(table.refcnt_key, delta)
 
-        widths: list[int] = []
-        for head in headers:
-            widths.append(len(head))
-        for msg in msgs:
+    def _get_refcnt_record(self, table: Table, pkey: bytes) -> int:
+        return self._get_refcnt(table.refcnt_record_prefix + pkey)
+
+    def _add_refcnt_record(self, table: Table, pkey: bytes, delta: int) -> None:
+        self._refcnt_delta(table.refcnt_record_prefix + pkey, delta)
+
+    # filter, project and format joined records of view, one row at a time
+    def _select_rows(self, gens: list[Iterable[QualRecord]], view: View, where: Where, cview: ColumnView | None) -> Iterable[list[str]]:
+        # everything but the values is fixed for the whole join
+        code = None if isinstance(where, WhereNOP) else where.compile(view)
+        indices = None if cview is None else cview.indices
+
+        # nested loop join: stream the first table, the others are read
+        # once and kept, product() would buffer every input
+        inner_vals = [[record.vals for record in gen] for gen in gens[1:]]
+        if not all(inner_vals):
+            return
+
+        for outer in gens[0]:
+            for inner in product(*inner_vals):
+                # generate full record by union
+                vals = list(outer.vals)
+                for record_vals in inner:
+                    vals += record_vals
+                if code is not None and not run_where(code, vals):
+                    continue
+
+                if indices is not None:
+                    vals = [vals[i] for i in indices]
+                yield [format_attr(val) for val in vals]
+
+    # consumes rows once, tracking widths as they arrive
+    def _render_select_streaming(self, headers: list[str], rows: Iterable[list[str]]) -> str:
+        widths = [len(head) for head in headers]
+        msgs: list[list[str]] = []
+        for msg in rows:
             for i, elem in enumerate(msg):
-                widths[i] = max(widths[i], len(elem))
+                if len(elem) > widths[i]:
+                    widths[i] = len(elem)
+            msgs.append(msg)
 
-        message = ''
         sep = '|'
         lsep = '+'
+        sep_line = lsep + sep.join('-'*(w+2) for w in widths) + lsep
+        fmt = sep + sep.join(f' {{:<{w+1}}}' for w in widths) + sep
 
-        message += lsep + sep.join('-'*(w+2) for w in widths) + lsep
-        message += '\n'
-        message += sep + sep.join(' ' + h.ljust(w+1) for h, w in zip(headers, widths)) + sep
-        message += '\n'
-        message += lsep + sep.join('-'*(w+2) for w in widths) + lsep
-
+        lines = [sep_line, fmt.format(*headers), sep_line]
         for msg in msgs:
-            message += '\n'
-            message += sep + sep.join(' ' + e.ljust(w+1) for e, w in zip(msg, widths)) + sep
-        message += '\n'
-        message += lsep + sep.join('-'*(w+2) for w in widths) + lsep
+            lines.append(fmt.format(*msg))
+        lines.append(sep_line)
 
-        return message
+        return '\n'.join(lines)
 
     def create_table(self, table: Table) -> DBMessage:
         for fkey in table.fkeys:
@@ -521,7 +982,8 @@ class DB:
             raise TableExistenceError
 
         for fkey in table.fkeys:
-            self._add_refcnt_table(fkey.ref_tname, 1)
+            self._add_refcnt_table(self._get_table(fkey.ref_tname), 1)
+        self._flush_refcnts()
 
         return CreateTableSuccess(table.tname)
 
@@ -539,66 +1001,88 @@ class DB:
     #    # get table (exists)
     #    # table.refcount == 0
     #    # for fkeys, ref.refcount--
+    #    # evict from self._table_cache
     #    pass
 
-    def insert_values(self, tname: str, record: Record) -> DBMessage:
-        try:
-            table = self._get_table(tname)
-        except KeyError:
-            raise NoSuchTableError
-
-        # cols unspecified
+    # full, checked record of table from the given values
+    def _full_record(self, table: Table, record: Record) -> Record:
+        # cols unspecified, already in table order
         if record.cnames is None:
             if len(table.cols) != len(record.vals):
                 raise InsertTypeMismatchError
-            record.cnames = [col.cname for col in table.cols]
-
-        # unspecified cols
-        if diff := set(record.cnames) - table.cnames():
-            raise InsertColumnExistenceError(diff.pop())
-
-        # construct record to insert
-        full_vals: list[Attr] = []
-        for col in table.cols:
-            if col.cname in record.cnames:
-                full_vals.append(record.vals[record.cnames.index(col.cname)])
-            else:
-                full_vals.append(None)
+            full_vals = record.vals
+        else:
+            # place given values by column position, the rest stay NULL
+            full_vals = [None] * len(table.cols)
+            for cname, val in zip(record.cnames, record.vals):
+                try:
+                    full_vals[table.col_indices[cname]] = val
+                except KeyError:
+                    # unspecified cols
+                    raise InsertColumnExistenceError(cname)
 
-            # check types
-            if not col.ctype.check_null(full_vals[-1]):
-                raise InsertColumnNonNullableError(col.cname)
-            if full_vals[-1] is not None and not col.ctype.check_type(full_vals[-1]):
-                raise InsertTypeMismatchError
-            # truncate strings
-            if isinstance(full_vals[-1], str):
-                full_vals[-1] = full_vals[-1][:col.ctype.cparam]
-        full_record = Record(full_vals, [col.cname for col in table.cols])
+        return Record(table.check_insert(full_vals), table.cname_list)
 
-        # check fkeys
-        fkey_rows: list[tuple[Table, bytes]] = []
-        for fkey in table.fkeys:
-            ref_table = self._get_table(fkey.ref_tname)
-            ref_record = fkey.ref_record(ref_table, full_record)
-            if ref_record is None:
-                continue
+    def insert_values(self, tname: str, record: Record) -> DBMessage:
+        self.insert_many(tname, [record])
+        return InsertResult()
 
-            ref_pkey = ref_record.pkey(ref_table)
-            try:
-                self._get_record(ref_table, ref_pkey)
-            except KeyError:
-                raise InsertReferentialIntegrityError
-            fkey_rows.append((ref_table, ref_pkey))
+    # insert records in order, returns the number inserted; every record is
+    # built and type checked before anything is stored, after that inserting
+    # stops at the first failing record and records before it stay inserted
+    def insert_many(self, tname: str, records: Iterable[Record]) -> int:
+        try:
+            table = self._get_table(tname)
+        except KeyError:
+            raise NoSuchTableError
 
+        full_records = [self._full_record(table, record) for record in records]
+
+        # referenced pkeys of each record, None for NULL fkeys
+        ref_tables = [self._get_table(fkey.ref_tname) for fkey in table.fkeys]
+        ref_pkeys: list[list[bytes | None]] = []
+        for full_record in full_records:
+            record_ref_pkeys: list[bytes | None] = []
+            for fkey, ref_table in zip(table.fkeys, ref_tables):
+                ref_record = fkey.ref_record(full_record)
+                record_ref_pkeys.append(None if ref_record is None else ref_record.pkey(ref_table))
+            ref_pkeys.append(record_ref_pkeys)
+
+        # probe each referenced row once for the whole batch, a table cannot
+        # reference itself so inserting does not change the answers
+        ref_exists: dict[tuple[str, bytes], bool] = {}
+        for i, ref_table in enumerate(ref_tables):
+            ref_db = self._open_table(ref_table)
+            for record_ref_pkeys in ref_pkeys:
+                ref_pkey = record_ref_pkeys[i]
+                if ref_pkey is not None and (ref_table.tname, ref_pkey) not in ref_exists:
+                    ref_exists[ref_table.tname, ref_pkey] = bool(ref_db.exists(ref_pkey))
+
+        inserted = 0
         try:
-            self._put_record(table, full_record)
-        except bdb.DBKeyExistError:
-            raise InsertDuplicatePrimaryKeyError
+            for full_record, record_ref_pkeys in zip(full_records, ref_pkeys):
+                # check fkeys
+                fkey_rows: list[tuple[Table, bytes]] = []
+                for ref_table, ref_pkey in zip(ref_tables, record_ref_pkeys):
+                    if ref_pkey is None:
+                        continue
+                    if not ref_exists[ref_table.tname, ref_pkey]:
+                        raise InsertReferentialIntegrityError
+                    fkey_rows.append((ref_table, ref_pkey))
 
-        for ref_table, ref_pkey in fkey_rows:
-            self._add_refcnt_record(ref_table.tname, ref_pkey, 1)
+                try:
+                    self._put_record(table, full_record)
+                except bdb.DBKeyExistError:
+                    raise InsertDuplicatePrimaryKeyError
 
-        return InsertResult()
+                for ref_table, ref_pkey in fkey_rows:
+                    self._add_refcnt_record(ref_table, ref_pkey, 1)
+                inserted += 1
+        finally:
+            # refcnts of the records stored so far
+            self._flush_refcnts()
+
+        return inserted
 
     #def insert_values():
     #    # get table
@@ -627,7 +1111,7 @@ class DB:
             where = WhereNOP()
         where.validate(view)
 
-        counter = self._delete_records(table, where)
+        counter = self._delete_records(table, view, where)
         return DeleteResult(counter)
 
     #def delete_values():
@@ -641,18 +1125,23 @@ class DB:
 
     def select_values(self, cview: ColumnView | None, tview: TableView, where: Where | None) -> DBMessage:
         # first pass for validation
-        view = View([], [])
+        idents: list[Ident] = []
+        cols: list[Column] = []
         tables: list[Table] = []
+        # position in tables of the table of each column
+        owners: list[int] = []
         for tname, alt_tname in zip(tview.tnames, tview.alt_tnames):
             try:
                 table = self._get_table(tname)
             except KeyError:
                 raise SelectTableExistenceError(tname)
 
-            tables.append(table)
             for col in table.cols:
-                view.idents.append(Ident(alt_tname, col.cname))
-                view.cols.append(col)
+                idents.append(Ident(alt_tname, col.cname))
+                cols.append(col)
+                owners.append(len(tables))
+            tables.append(table)
+        view = View(idents, cols)
 
         if cview is None:
             # if *, all cnames must be unique
@@ -663,21 +1152,26 @@ class DB:
                 cnames.add(col.cname)
         else:
             # otherwise, every selected column must be unique
-            for ident in cview.idents:
-                try:
-                    view.find(ident)
-                except DBError:
-                    raise SelectColumnResolveError(ident.cname)
+            cview.bind(view)
 
         # ensure where is valid
         if where is None:
             where = WhereNOP()
         where.validate(view)
 
+        # filter on single tables while scanning, before the product
+        filters, where = where.split_by_table(view, owners)
+
         # second pass for actual fetch
         gens: list[Iterable[QualRecord]] = []
-        for table, alt_tname in zip(tables, tview.alt_tnames):
-            gens.append(self._generate_records(table, alt_tname))
+        for pos, (table, alt_tname) in enumerate(zip(tables, tview.alt_tnames)):
+            table_where = filters.get(pos, WhereNOP())
+            table_view = View(
+                idents=[Ident(alt_tname, col.cname) for col in table.cols],
+                cols=table.cols,
+            )
+            table_where.validate(table_view)
+            gens.append(self._generate_records(table, table_view, table_where))
 
         # prepare header
         if cview is None:
@@ -685,23 +1179,8 @@ class DB:
         else:
             headers = cview.alt_cnames
 
-        # prepare records
-        rows: list[list[Attr]] = []
-        for records in product(*gens):
-            # generate full record by union
-            full_record = QualRecord([], [])
-            for record in records:
-                full_record.vals += record.vals
-                full_record.idents += record.idents
-            if not where.evaluate(full_record):
-                continue
-
-            if cview is not None:
-                full_record = cview.project(full_record)
-
-            rows.append(full_record.vals)
-
-        return DBMessage(self._render_select(headers, rows))
+        rows = self._select_rows(gens, view, where, cview)
+        return DBMessage(self._render_select_streaming(headers, rows))
 
     #def select_values():
     #    # get tables (exists)
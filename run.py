@@ -1,16 +1,50 @@
+from collections import Counter
 from contextlib import closing
 from datetime import date
-from typing import Any, Union, no_type_check
+from functools import lru_cache
+from operator import itemgetter
+from typing import Any, Callable, Iterator, Union, no_type_check
+import os
 import sys
 
 from lark import Lark, Transformer, UnexpectedInput, Token, Tree
-from lark.exceptions import VisitError
+# optional, faster lexer and parser
+LARK_PLUGINS: dict[str, Any]
+try:
+    import lark_cython # type: ignore
+    LARK_PLUGINS = lark_cython.plugins
+except ImportError:
+    LARK_PLUGINS = {}
 
 from db_messages import *
 import db
 
 PROMPT = 'DB_2017-19937>'
 
+# identifiers are interned so repeated names share one str object, and the
+# dict lookups against schema names compare by identity
+_intern = sys.intern
+
+# comparison operator lexemes and literal token types, for table dispatch
+_COMP_OPS: dict[str, db.CompOp] = {
+    '<': db.CompOp.LESSTHAN,
+    '<=': db.CompOp.LESSEQUAL,
+    '>': db.CompOp.GREATERTHAN,
+    '>=': db.CompOp.GREATEREQUAL,
+    '=': db.CompOp.EQUAL,
+    '!=': db.CompOp.NOTEQUAL,
+}
+# date literals tend to recur across bulk INSERTs, so memoize them
+@lru_cache(maxsize=4096)
+def _parse_date(s: str) -> date:
+    return date.fromisoformat(s)
+_strip_quotes: Callable[[str], str] = itemgetter(slice(1, -1))
+_VALUE_CTORS: dict[str, Callable[[str], db.Attr]] = {
+    'INT': int,
+    'STR': _strip_quotes,
+    'DATE': _parse_date,
+}
+
 # Utility functions for priting
 def println_prompt(msg: Any) -> None:
     print(PROMPT, msg)
@@ -24,54 +58,57 @@ class PrintTransformer(Transformer[Any, Any]):
 
     # handle CREATE TABLE
     def create_table_query(self, args: Any) -> None:
-        tname = args[2].children[0].lower()
+        tname = _intern(args[2].children[0].value.lower())
 
-        # parse columns
-        column_defs = args[3].find_data('column_definition')
+        # one pass over the table elements, in order, between the parens
         cols = []
-        for column_def in column_defs:
-            cname = column_def.children[0].children[0].lower()
-
-            data_type = column_def.children[1].children
-            data_class = data_type[0].upper()
-            if data_class == 'INT':
-                ctype = db.CType(cclass=db.CClass.INT)
-            elif data_class == 'CHAR':
-                ctype = db.CType(
-                    cclass=db.CClass.CHAR,
-                    cparam=int(data_type[2]),
-                )
-                if ctype.cparam is None or ctype.cparam < 0:
-                    raise SyntaxError
-            elif data_class == 'DATE':
-                ctype = db.CType(cclass=db.CClass.DATE)
-
-            ctype.nullable = column_def.children[2] is None
-            cols.append(db.Column(cname, ctype))
-
-        # parse pkeys
-        pkey_defs = args[3].find_data('primary_key_constraint')
         pkeys = set()
-        for pkey_def in pkey_defs:
-            column_names = pkey_def.children[2].find_data('column_name')
-            for column_name in column_names:
-                pkeys.add(column_name.children[0].lower())
-
-        # parse fkeys
-        fkey_defs = args[3].find_data('referential_constraint')
         fkeys = []
-        for fkey_def in fkey_defs:
-            ref_tname = fkey_def.children[4].children[0].lower()
-
-            cnames = []
-            for col_def in fkey_def.children[2].find_data('column_name'):
-                cnames.append(col_def.children[0].lower())
-            ref_cnames = []
-            for col_def in fkey_def.children[5].find_data('column_name'):
-                ref_cnames.append(col_def.children[0].lower())
-
-            cname_map = {c: r for c, r in zip(cnames, ref_cnames)}
-            fkeys.append(db.FKey(ref_tname, cname_map))
+        for element in args[3].children[1:-1]:
+            node = element.children[0]
+            if node.data == 'table_constraint_definition':
+                node = node.children[0]
+
+            # parse columns
+            if node.data == 'column_definition':
+                cname = _intern(node.children[0].children[0].value.lower())
+
+                data_type = node.children[1].children
+                data_class = data_type[0].value.upper()
+                if data_class == 'INT':
+                    ctype = db.CType(cclass=db.CClass.INT)
+                elif data_class == 'CHAR':
+                    ctype = db.CType(
+                        cclass=db.CClass.CHAR,
+                        cparam=int(data_type[2].value),
+                    )
+                    if ctype.cparam is None or ctype.cparam < 0:
+                        raise SyntaxError
+                elif data_class == 'DATE':
+                    ctype = db.CType(cclass=db.CClass.DATE)
+
+                ctype.nullable = node.children[2] is None
+                cols.append(db.Column(cname, ctype))
+
+            # parse pkeys
+            elif node.data == 'primary_key_constraint':
+                column_names = node.children[2].find_data('column_name')
+                for column_name in column_names:
+                    pkeys.add(_intern(column_name.children[0].value.lower()))
+
+            # parse fkeys
+            elif node.data == 'referential_constraint':
+                ref_tname = _intern(node.children[4].children[0].value.lower())
+
+                cnames = []
+                for col_def in node.children[2].find_data('column_name'):
+                    cnames.append(_intern(col_def.children[0].value.lower()))
+                ref_cnames = []
+                for col_def in node.children[5].find_data('column_name'):
+                    ref_cnames.append(_intern(col_def.children[0].value.lower()))
+
+                cname_map = {c: r for c, r in zip(cnames, ref_cnames)}
+                fkeys.append(db.FKey(ref_tname, cname_map))
 
         # don't do any validation on create, not graded
         table = db.Table(tname, cols, pkeys, fkeys)
@@ -92,37 +129,24 @@ class PrintTransformer(Transformer[Any, Any]):
 
     # convert WHERE clauses in the parser
     def boolean_expr(self, args: list[db.Where]) -> db.Where:
-        return db.WhereOr(*args[::2])
+        if len(args) == 1:
+            return args[0]
+        return db.WhereOr(args[::2])
     def boolean_term(self, args: list[db.Where]) -> db.Where:
-        return db.WhereAnd(*args[::2])
+        if len(args) == 1:
+            return args[0]
+        return db.WhereAnd(args[::2])
     def boolean_factor(self, args: tuple[Any, db.Where]) -> db.Where:
         if args[0] is not None:
             return db.WhereNot(args[1])
         return args[1]
-    def boolean_test(self, args: tuple[db.Where]) -> db.Where:
-        return args[0]
-    def parenthesized_boolean_expr(self, args: tuple[Any, db.Where]) -> db.Where:
-        return args[1]
-    def predicate(self, args: tuple[db.Where]) -> db.Where:
-        return args[0]
 
     # comparison, like A < B
     @no_type_check
     def comparison_predicate(self, args) -> db.Where:
-        oper = args[1].children[0].value
-        if oper == '<':
-            oper = db.CompOp.LESSTHAN
-        elif oper == '<=':
-            oper = db.CompOp.LESSEQUAL
-        elif oper == '>':
-            oper = db.CompOp.GREATERTHAN
-        elif oper == '>=':
-            oper = db.CompOp.GREATERTHANEQUAL
-        elif oper == '=':
-            oper = db.CompOp.EQUAL
-        elif oper == '!=':
-            oper = db.CompOp.NOTEQUAL
-        else:
+        try:
+            oper = _COMP_OPS[args[1].children[0].value]
+        except KeyError:
             raise SyntaxError
         return db.WhereComp(args[0], args[2], oper)
 
@@ -131,37 +155,29 @@ class PrintTransformer(Transformer[Any, Any]):
     def null_predicate(self, args) -> db.Where:
         tname = args[0]
         if tname is not None:
-            tname = tname.children[0].lower()
-        cname = args[1].children[0].lower()
+            tname = _intern(tname.children[0].value.lower())
+        cname = _intern(args[1].children[0].value.lower())
 
         where = db.WhereNull(db.Ident(tname, cname))
-        if args[2].children[1]:
+        if args[2].children[1] is not None:
             where = db.WhereNot(where)
         return where
 
     # literals, used in both INSERT VALUES and WHERE
     def comparable_value(self, args: list[Token]) -> db.Attr:
-        if args[0].type == 'INT':
-            return int(args[0])
-        elif args[0].type == 'STR':
-            return args[0][1:-1]
-        elif args[0].type == 'DATE':
-            return date.fromisoformat(args[0])
-        else:
+        try:
+            ctor = _VALUE_CTORS[args[0].type]
+        except KeyError:
             raise SyntaxError
+        return ctor(args[0].value)
 
     # comparison operands
     @no_type_check
     def comp_operand(self, args) -> db.Operand:
-        # literal
-        if len(args) == 1:
-            return args[0]
-
-        # ident
         tname = args[0]
         if tname is not None:
-            tname = tname.children[0].lower()
-        cname = args[1].children[0].lower()
+            tname = _intern(tname.children[0].value.lower())
+        cname = _intern(args[1].children[0].value.lower())
 
         return db.Ident(tname, cname)
 
@@ -178,12 +194,12 @@ class PrintTransformer(Transformer[Any, Any]):
             for select_def in select_defs:
                 tname = select_def.children[0]
                 if tname is not None:
-                    tname = tname.children[0].lower()
-                cname = select_def.children[1].children[0].lower()
+                    tname = _intern(tname.children[0].value.lower())
+                cname = _intern(select_def.children[1].children[0].value.lower())
 
                 alt_cname = select_def.children[3]
                 if alt_cname is not None:
-                    alt_cname = alt_cname.children[0].lower()
+                    alt_cname = _intern(alt_cname.children[0].value.lower())
                 else:
                     alt_cname = cname
 
@@ -191,18 +207,18 @@ class PrintTransformer(Transformer[Any, Any]):
                 cview.alt_cnames.append(alt_cname)
 
             # cannot have duplicate target columns
-            for cname in cview.alt_cnames:
-                if cview.alt_cnames.count(cname) > 1:
+            for cname, count in Counter(cview.alt_cnames).items():
+                if count > 1:
                     raise SelectColumnResolveError(cname)
 
         # parse FROMs
         table_defs = args[2].find_data('referred_table')
         tview = db.TableView([], [])
         for table_def in table_defs:
-            tname = table_def.children[0].children[0].lower()
+            tname = _intern(table_def.children[0].children[0].value.lower())
             alt_tname = table_def.children[2]
             if alt_tname is not None:
-                alt_tname = alt_tname.children[0].lower()
+                alt_tname = _intern(alt_tname.children[0].value.lower())
             else:
                 alt_tname = tname
 
@@ -211,9 +227,10 @@ class PrintTransformer(Transformer[Any, Any]):
 
         # all tables in SELECT must be in FROM
         if cview is not None:
-            c_tnames = set(ident.tname for ident in cview.idents if ident.tname is not None)
-            if diff := c_tnames - set(tview.alt_tnames):
-                raise SelectTableExistenceError(diff.pop())
+            alt_set = set(tview.alt_tnames)
+            for ident in cview.idents:
+                if ident.tname is not None and ident.tname not in alt_set:
+                    raise SelectTableExistenceError(ident.tname)
 
         # WHERE has already been parsed
         where_def = args[2].children[1]
@@ -228,11 +245,11 @@ class PrintTransformer(Transformer[Any, Any]):
     @no_type_check
     def insert_query(self, args):
         # parse columns
-        tname = args[2].children[0].lower()
+        tname = _intern(args[2].children[0].value.lower())
         if args[3] is not None:
             cnames = []
             for col_def in args[3].find_data('column_name'):
-                cnames.append(col_def.children[0].lower())
+                cnames.append(_intern(col_def.children[0].value.lower()))
             if len(cnames) != len(set(cnames)):
                 raise InsertTypeMismatchError
         else:
@@ -250,7 +267,7 @@ class PrintTransformer(Transformer[Any, Any]):
     # handle DELETE
     @no_type_check
     def delete_query(self, args):
-        tname = args[2].children[0].lower()
+        tname = _intern(args[2].children[0].value.lower())
         if args[3] is None:
             where = None
         else:
@@ -261,36 +278,89 @@ class PrintTransformer(Transformer[Any, Any]):
     def update_query(self, args: Any) -> None:
         println_prompt("'UPDATE' requested")
 
-    def EXIT(self, args: Any) -> None:
-        sys.exit(0)
-        print('exit')
+    # EXIT is only a token, handle it once the whole command is parsed
+    def command(self, args: list[Any]) -> None:
+        if getattr(args[0], 'type', None) == 'EXIT':
+            sys.exit(0)
+
+# split input into ';'-terminated statements, ignoring ';' inside string
+# literals; anything after the last ';' is dropped, unless it is inside an
+# unterminated literal, which is passed on for the parser to reject
+def _iter_statements(s: str) -> Iterator[str]:
+    start = 0
+    quote = ''
+    escaped = False
+    for i, ch in enumerate(s):
+        if quote:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == quote:
+                quote = ''
+        elif ch == "'" or ch == '"':
+            quote = ch
+        elif ch == ';':
+            yield s[start:i + 1]
+            start = i + 1
+    if quote:
+        yield s[start:]
+
+# input lines until EOF; scripts piped into stdin are read in one go
+# instead of one input() call per line
+def _input_lines() -> Iterator[str]:
+    if not sys.stdin.isatty():
+        yield from sys.stdin.read().splitlines()
+        return
+    while True:
+        try:
+            yield input()
+        except EOFError:
+            return
 
 def run() -> None:
-    with open('grammar.lark', 'r') as f:
-        sql_parser = Lark(f.read(), start='command', lexer='basic')
+    # opt-in: re-exec under PyPy, whose JIT does well on the many small
+    # transformer callbacks; stay on CPython if pypy3 cannot be run
+    if sys.implementation.name == 'cpython' and os.environ.get('DB_FORCE_PYPY'):
+        try:
+            os.execvp('pypy3', ['pypy3'] + sys.argv)
+        except OSError:
+            pass
 
     with closing(db.DB('myDB.db')) as ndb:
-        trans = PrintTransformer(ndb)
+        with open('grammar.lark', 'r') as f:
+            # statements run as the parser reduces them, no tree is built for
+            # the whole command; compiled tables are cached in the temp dir,
+            # keyed by grammar and options; lark_cython runs the lexer and
+            # parser if installed
+            sql_parser = Lark(
+                f.read(), start='command', parser='lalr', lexer='basic',
+                cache=True, transformer=PrintTransformer(ndb),
+                _plugins=LARK_PLUGINS,
+            )
+
+        source = _input_lines()
         while True:
-            query = ''
+            # collect lines and join once; trailing whitespace after the
+            # final ';' still ends the statement
+            lines: list[str] = []
             print_prompt()
-            while not (query and query[-1] == ';'):
-                query += input()
+            for line in source:
+                lines.append(line)
+                if line.rstrip().endswith(';'):
+                    break
+            else:
+                return
+            query = ''.join(lines)
 
-            for q in query.split(';')[:-1]:
+            for q in _iter_statements(query):
                 try:
-                    output = sql_parser.parse(q + ';')
+                    sql_parser.parse(q)
                 except UnexpectedInput:
                     println_prompt('Syntax error')
                     break
-
-                try:
-                    trans.transform(output)
-                except VisitError as e:
-                    if isinstance(e.orig_exc, DBError):
-                        println_prompt(e.orig_exc)
-                    else:
-                        raise
+                except DBError as e:
+                    println_prompt(e)
 
 if __name__ == '__main__':
     run()